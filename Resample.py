@@ -34,20 +34,39 @@ This software is designed to resample data based on either Year or Depth or both
 
 import pandas as pd
 import os
+import re
 import numpy as np
 import sys
-from scripts.func import frange
+from concurrent.futures import ProcessPoolExecutor
 from math import isnan
 import matplotlib.pyplot as plt
 from matplotlib.backends.backend_pdf import PdfPages
 from typing import List, Tuple
 
+try:
+    from numba import njit, prange, set_num_threads
+except ImportError:
+    njit = None
+    prange = range
+
+# parquet files are optional, without pyarrow the writes fail with
+# ImportError which is caught alongside
+try:
+    from pyarrow import ArrowException
+except ImportError:
+    ArrowException = ImportError
+
+# column names starting or ending with these are resampled by
+DEPTH_RE = re.compile(r'^depth|depth$',re.IGNORECASE)
+YEAR_RE = re.compile(r'^(?:year|age|time)|(?:year|age|time)$',re.IGNORECASE)
+
 def file_to_dataframe(file:str) -> pd.DataFrame:
     '''
     ------------------------------------------------------------
     file_to_dataframe functions
 
-    - used to input file from user input
+    - used to input file from user input, a parquet copy of the file is
+        cached next to it and read instead while it is up to date
     ------------------------------------------------------------
     Input:
         file : string from user input of file
@@ -56,6 +75,15 @@ def file_to_dataframe(file:str) -> pd.DataFrame:
         data : pd.DataFrame from user input file
     ------------------------------------------------------------
     '''
+    # the cache is only a speed up, if it can't be read or written the
+    # source file is parsed as usual
+    cache = file + '.parquet'
+    if os.path.exists(cache) and os.path.getmtime(cache) > os.path.getmtime(file):
+        try:
+            return pd.read_parquet(cache,engine='pyarrow')
+        except (ImportError,ValueError,ArrowException,OSError) as e:
+            print('input cache {} not read: {}'.format(os.path.basename(cache),e))
+
     if file.endswith('.csv'):
         data = pd.read_csv(file)
     elif file.endswith('.xlsx'):
@@ -65,6 +93,17 @@ def file_to_dataframe(file:str) -> pd.DataFrame:
     else:
         print('Dataset inputted is not an .csv, .xlsx or .txt, change file type')
 
+    # write to a temporary file first so an interrupted run can't leave a
+    # truncated cache behind
+    tmp = '{}.{}.tmp'.format(cache,os.getpid())
+    try:
+        data.to_parquet(tmp,engine='pyarrow')
+        os.replace(tmp,cache)
+    except (ImportError,ValueError,ArrowException,OSError) as e:
+        print('input cache {} not written: {}'.format(os.path.basename(cache),e))
+        if os.path.exists(tmp):
+            os.remove(tmp)
+
     return data
 
 def find_by_columns(data:pd.DataFrame,by:str) -> Tuple[List,str]:
@@ -83,19 +122,18 @@ def find_by_columns(data:pd.DataFrame,by:str) -> Tuple[List,str]:
         name : generic name of either Depth or Year
     ------------------------------------------------------------
     '''
-    if (by.startswith(('Depth','depth'))):
-        by =  [i for i in data.columns if (i.startswith(('depth','Depth','DEPTH'))) \
-                | (i.endswith(('depth','Depth','DEPTH')))]
+    columns = data.columns.to_series()
+    by_lower = by.lower()
+
+    if by_lower.startswith('depth'):
+        by = data.columns[columns.str.contains(DEPTH_RE,na=False)].tolist()
         name = 'Depth'
-    elif (by.startswith(('year','Year','age','Age','Time','YEAR','AGE'))):
-        by =  [i for i in data.columns if (i.startswith(('year','Year','age','Age','Time','YEAR','AGE'))) \
-                | (i.endswith(('year','Year','age','Age','Time','YEAR','AGE')))]
+    elif by_lower.startswith(('year','age','time')):
+        by = data.columns[columns.str.contains(YEAR_RE,na=False)].tolist()
         name = 'Year'
-    elif (by.startswith(('all','All','ALL','Both','BOTH'))):
-        by1 =  [i for i in data.columns if (i.startswith(('depth','Depth','DEPTH'))) \
-                | (i.endswith(('depth','Depth','DEPTH')))]
-        by2 =  [i for i in data.columns if (i.startswith(('year','Year','age','Age','Time','YEAR','AGE'))) \
-                | (i.endswith(('year','Year','age','Age','Time','YEAR','AGE')))]
+    elif by_lower.startswith(('all','both')):
+        by1 = data.columns[columns.str.contains(DEPTH_RE,na=False)].tolist()
+        by2 = data.columns[columns.str.contains(YEAR_RE,na=False)].tolist()
         by = [by1,by2]
         name =['Depth','Year']
 
@@ -114,26 +152,30 @@ def check_resample(n_idx:List,inc_amt:float) -> float:
         values in a row
     ------------------------------------------------------------
     Input:
-        n_idx      : list of index where all NaNs values are found
+        n_idx      : list or array of index where all NaNs values are found
                         ( Area of dataset where not enough points to get mean)
         inc_amt    : increment amount to resample data by
 
     Output:
         stop_point : index values when there are more than 5 indexes
-                        with all NaN values in a row
+                        with all NaN values in a row, None if there are none
     ------------------------------------------------------------
     '''
-    z = 0
-    n_idx.reverse()
-
-    for i in range(1,len(n_idx)-1):
-        if n_idx[i]+inc_amt ==n_idx[i-1]:
-            z=z+1
-            if z == 5:
-                stop_point = n_idx[i]
-                print("Due to decreasing resolution of the data, we are not able to resample below the end point")
-                print('end point = {}'.format(stop_point))
-                return stop_point
+    arr = np.asarray(n_idx,dtype=np.float64)[::-1]
+
+    # flag each pair of neighbouring all NaN indexes one increment apart,
+    # then look for the first run of 5 such steps
+    step = np.isclose(np.diff(arr),-inc_amt)
+    if len(step) < 5:
+        return None
+    run = np.convolve(step.astype(np.int8),np.ones(5,np.int8),'valid')
+    if not (run == 5).any():
+        return None
+
+    stop_point = arr[np.argmax(run == 5)+5]
+    print("Due to decreasing resolution of the data, we are not able to resample below the end point")
+    print('end point = {}'.format(stop_point))
+    return stop_point
 
 def set_index(df:pd.DataFrame,by:str) -> pd.DataFrame:
     '''
@@ -147,17 +189,74 @@ def set_index(df:pd.DataFrame,by:str) -> pd.DataFrame:
         by:      column to set as index
 
     Output:
-        df: raw dataset with by as index
+        df: raw dataset with by as index, sorted by index
     ------------------------------------------------------------
     '''
 
     if not df.index.name == by:
-        try:
-            df = df.set_index(by)
-        except:
-            print('{} is not found as a column in the dataset, insert name of column to resample data by'.format(by))
+        if by not in df.columns:
+            raise KeyError('{} is not found as a column in the dataset, insert name of column to resample data by'.format(by))
+        df = df.set_index(by)
+
+    # sort once here so every resample of this column can rely on a
+    # monotonic index
+    if not df.index.is_monotonic_increasing:
+        df = df.sort_index()
     return df
 
+def _bin_means(values:np.ndarray,lo:np.ndarray,hi:np.ndarray) -> Tuple[np.ndarray,np.ndarray]:
+    '''
+    ------------------------------------------------------------
+    _bin_means function
+
+    - used to average every column of values over the row ranges
+        lo:hi of each bin, skipping NaN values (compiled with numba
+        if installed)
+    ------------------------------------------------------------
+    Input:
+        values  : 2D float32 array of samples (rows) by columns, rows
+                    sorted by index, column-major (Fortran order) so
+                    each column is read contiguously
+        lo      : 1D int array of first row of each bin
+        hi      : 1D int array of row after the last row of each bin
+
+    Output:
+        means   : 2D float64 array of bin means, NaN for empty bins
+        all_nan : 1D bool array, True for bins with no values in any column
+    ------------------------------------------------------------
+    '''
+    n_cols = values.shape[1]
+    n_bins = len(lo)
+    means = np.full((n_bins,n_cols),np.nan)
+    all_nan = np.ones(n_bins,np.bool_)
+
+    for c in prange(n_cols):
+        for b in range(n_bins):
+            total = 0.0
+            comp = 0.0
+            count = 0
+            for j in range(lo[b],hi[b]):
+                v = values[j,c]
+                if np.isnan(v):
+                    continue
+                # Kahan compensated summation
+                y = v - comp
+                t = total + y
+                comp = (t - total) - y
+                total = t
+                count += 1
+            if count > 0:
+                means[b,c] = total/count
+                # columns only ever clear the flag, so threads can share it
+                all_nan[b] = False
+
+    return means, all_nan
+
+# fastmath is left off, it would let the compiler drop the NaN checks
+# and the Kahan compensation term
+if njit is not None:
+    _bin_means = njit(nogil=True,parallel=True,cache=True)(_bin_means)
+
 def resample(df:pd.DataFrame,by:str,inc_amt:float) -> pd.DataFrame:
     '''
     ------------------------------------------------------------
@@ -179,29 +278,54 @@ def resample(df:pd.DataFrame,by:str,inc_amt:float) -> pd.DataFrame:
     bot = int(df.index.max())
     inc = inc_amt/2
 
-    range_list = list(frange(top,bot,inc_amt))
-
-    df_new = pd.DataFrame()
+    range_list = np.arange(top,bot,inc_amt,dtype=np.float64)
+
+    if not df.index.is_monotonic_increasing:
+        df = df.sort_index()
+
+    # only numeric columns can be averaged, others (e.g. sample IDs) are
+    # left out of the output as DataFrame.mean used to do
+    df = df.select_dtypes('number')
+
+    # columns without any measurements can only average to NaN, leave
+    # them out of the binning and add them back afterwards
+    columns = df.columns
+    df = df.loc[:,df.notna().any(axis=0)]
+
+    # assign every sample to the bin centred on the nearest increment,
+    # i.e. [i-inc, i+inc), and average all bins in a single pass
+    if njit is not None:
+        idx = df.index.values
+        lo = np.searchsorted(idx,range_list-inc)
+        hi = np.searchsorted(idx,range_list+inc)
+        # column-major float32 so each column the kernel sweeps is one
+        # contiguous run at half the bytes of float64, the sums are still
+        # accumulated in float64
+        values = np.asfortranarray(df.values,dtype=np.float32)
+        means, all_nan = _bin_means(values,lo,hi)
+        df_new = pd.DataFrame(means,columns=df.columns,index=pd.Index(range_list,name=by))
+    else:
+        bin_id = np.floor((df.index.values - top)/inc_amt + 0.5).astype(np.int64)
+        df_new = df.groupby(bin_id).mean()
+        df_new = df_new.reindex(np.arange(len(range_list)))
+        df_new = df_new.set_index(pd.Series(range_list,name=by))
+        all_nan = df_new.isnull().all(axis=1).values
 
-    n_idx =[]
-    for i in range_list:
-        idx = df[( df.index >=i-inc) & ( df.index < i+inc)]
-        df_new = df_new.append(idx.mean(),ignore_index=True)
+    df_new = df_new.reindex(columns=columns)
 
-        if idx.mean().isnull().all():
-            n_idx.append(i)
+    n_idx = range_list[all_nan]
 
     end = check_resample(n_idx,inc_amt)
 
-
-    df_new = df_new.set_index(pd.Series(range_list))
-    df_new.index.name = by
-    df_new = df_new[::-1]
-    df_new = df_new.loc[:end]
+    # reverse, then keep everything down to and including the end point
+    df_new = df_new.iloc[::-1]
+    if end is not None:
+        cut = np.searchsorted(-df_new.index.values,-end,side='right')
+        df_new = df_new.iloc[:cut]
 
     return df_new
 
-def create_output_filename_and_folders(by:str,inc_amt:float,name:str) -> str:
+def create_output_filename_and_folders(by:str,inc_amt:float,name:str,base:str) -> str:
     '''
     ------------------------------------------------------------
     output function
@@ -212,6 +336,7 @@ def create_output_filename_and_folders(by:str,inc_amt:float,name:str) -> str:
         by      : column name to resample data by
         inc_amt : increment amount
         name    : name of objective to resample by (Year or Depth)
+        base    : name of the input file without extension
 
 
     Output:
@@ -219,20 +344,10 @@ def create_output_filename_and_folders(by:str,inc_amt:float,name:str) -> str:
     ------------------------------------------------------------
     '''
     folder = os.path.join(os.getcwd(), 'output_files')
-    if not os.path.exists(folder):
-        os.makedirs(folder)
-
     filefolder = os.path.join(folder, base)
-    if not os.path.exists(filefolder):
-        os.makedirs(filefolder)
-
     namefolder = os.path.join(filefolder,"Resampled_by_{}".format(name))
-    if not os.path.exists(namefolder):
-        os.makedirs(namefolder)
-
     incfolder = os.path.join(namefolder,"{}".format(inc_amt))
-    if not os.path.exists(incfolder):
-        os.makedirs(incfolder)
+    os.makedirs(incfolder,exist_ok=True)
 
     filename = '{}_{}_r{}'.format(base,by.replace(" ", "_"),inc_amt)
     outfile =os.path.join(incfolder,filename)
@@ -243,7 +358,7 @@ def output(data:pd.DataFrame,raw_data:pd.DataFrame,outfile:str):
     ------------------------------------------------------------
     output function
 
-    - used to create folder and csv files for resampled output of data
+    - used to create csv, parquet and pdf files for resampled output of data
     ------------------------------------------------------------
     Input:
         data     : resampled dataset
@@ -252,14 +367,26 @@ def output(data:pd.DataFrame,raw_data:pd.DataFrame,outfile:str):
 
 
     Output:
-        csv and pdf files of resampled data
+        csv, parquet and pdf files of resampled data
     ------------------------------------------------------------
     '''
     outfile_base = os.path.basename(outfile)
     print("")
     print("Creating output csv file : {}".format(outfile_base))
 
-    data.to_csv(outfile+'.csv')
+    # float_format would also round the bin centres, write them as text
+    # at full precision so fine increments keep distinct labels
+    index = pd.Index([str(float(i)) for i in data.index],name=data.index.name)
+    data.set_axis(index,axis=0).to_csv(outfile+'.csv',float_format='%.6g',chunksize=100000)
+
+    # parquet copy for faster re-reads, skipped if pyarrow is missing or
+    # the data can't be stored (e.g. non-string column names)
+    try:
+        data.to_parquet(outfile+'.parquet',engine='pyarrow',compression='zstd')
+    except (ImportError,ValueError,ArrowException,OSError) as e:
+        print('parquet output skipped: {}'.format(e))
+        if os.path.exists(outfile+'.parquet'):
+            os.remove(outfile+'.parquet')
 
     print("Creating output pdf plot file : {}".format(outfile_base))
 
@@ -284,46 +411,114 @@ def plot_output(data:pd.DataFrame,raw_data:pd.DataFrame,outfile:str,log):
         pdf files of resampled and raw data in normal and log scale
     ------------------------------------------------------------
     '''
+    # thin out the raw data to ~5000 points per plot, the resampled line
+    # is what the plot is about and the pdf stays small
+    stride = max(1,len(raw_data)//5000)
+
+    fig, ax = plt.subplots(figsize=(8,5))
     with PdfPages(outfile) as pdf:
         for i in data.columns:
-            ax = raw_data[i].plot(figsize=(8,5), color = 'gray',legend=True)
-            data[i].plot(ax=ax,color = 'firebrick')
+            ax.clear()
+            ax.plot(raw_data.index.values[::stride],raw_data[i].values[::stride],
+                    color = 'gray',rasterized=True,label='{}: Raw'.format(i))
+            ax.plot(data.index.values,data[i].values,
+                    color = 'firebrick',label='{}: Resampled'.format(i))
             if log:
                 ax.semilogy()
-            ax.legend(['{}: Resampled'.format(i),'{}: Raw'.format(i)])
-            plt.tight_layout()
-            fig = plt.gcf()
-            pdf.savefig(fig)
-            plt.close()
+            ax.set_xlabel(data.index.name)
+            ax.legend()
+            fig.tight_layout()
+            pdf.savefig(fig,dpi=100)
+    plt.close(fig)
 
-def set_resample(raw_data_input:pd.DataFrame,by:str,inc_amt:float,name:str):
+# raw data indexed by each resample column, set once per worker process
+# by _init_worker so it is not pickled again for every task
+_worker_raw_data = {}
+
+def _init_worker(raw_data:dict,n_threads:int):
+    '''
+    ------------------------------------------------------------
+    _init_worker function
+
+    - used to set up each worker process of set_resample
+    ------------------------------------------------------------
+    Input:
+        raw_data  : dict of column name to raw data with that column
+                     as index
+        n_threads : number of threads for the numba kernel
+    ------------------------------------------------------------
+    '''
+    global _worker_raw_data
+    _worker_raw_data = raw_data
+
+    # share the cores between the workers so the pool and the numba
+    # kernel together don't start more threads than there are cores
+    if njit is not None:
+        set_num_threads(n_threads)
+
+def _run_one(by:str,inc_amt:float,name:str,base:str):
+    '''
+    ------------------------------------------------------------
+    _run_one function
+
+    - used to resample and write the output files for one column and
+        increment amount, run in a worker process by set_resample
+    ------------------------------------------------------------
+    Input:
+        by       : column to resample data by
+        inc_amt  : increment amount
+        name     : name of objective to resample by (Year or Depth)
+        base     : name of the input file without extension
+
+    Output:
+        PDF and CSV files
+    ------------------------------------------------------------
+    '''
+    print("")
+    print("Resampling by {} : {}, Increment Amount: {}".format(name, by, inc_amt))
+    raw_data = _worker_raw_data[by]
+    resampled = resample(raw_data,by,inc_amt)
+    outfile = create_output_filename_and_folders(by,inc_amt,name,base)
+    output(resampled,raw_data,outfile)
+
+def set_resample(raw_data_input:pd.DataFrame,by:str,inc_amt:float,name:str,base:str):
     '''
     ------------------------------------------------------------
     set_resample function
 
-    - used to run through sets of user specified inputs to resample
+    - used to run through sets of user specified inputs to resample,
+        each column and increment amount pair is run in its own process
     ------------------------------------------------------------
     Input:
         raw_data_input : raw data in a DataFrame from user input
         by             : columns to resample data by
         inc_amt        : increment amount
+        name           : name of objective to resample by (Year or Depth)
+        base           : name of the input file without extension
 
     Output:
         PDF and CSV files
     ------------------------------------------------------------
     '''
-    for b in by:
-        print("")
-        print('Resampling by {} : {} '.format(name,b))
-        for i in inc_amt:
-            print("")
-            print("Resampling for {} Increment Amount: {}".format(name, i))
-            raw_data = set_index(raw_data_input,b)
-            resampled = resample(raw_data,b,i)
-            outfile = create_output_filename_and_folders(b,i,name)
-            output(resampled,raw_data,outfile)
-
-def user_input(raw_data_input:pd.DataFrame,by:str,inc_amt:float,name:str):
+    raw_data = {b: set_index(raw_data_input,b) for b in by}
+
+    n_cpus = os.cpu_count() or 1
+    n_tasks = len(by)*len(inc_amt)
+    n_workers = max(1,min(n_cpus,n_tasks))
+    n_threads = max(1,n_cpus//n_workers)
+
+    with ProcessPoolExecutor(max_workers=n_workers,initializer=_init_worker,
+                             initargs=(raw_data,n_threads)) as executor:
+        futures = []
+        for b in by:
+            for i in inc_amt:
+                futures.append(executor.submit(_run_one,b,i,name,base))
+
+        # re-raise any error from the workers
+        for future in futures:
+            future.result()
+
+def user_input(raw_data_input:pd.DataFrame,by:str,inc_amt:float,name:str,base:str):
     '''
     ------------------------------------------------------------
     user_input function
@@ -334,6 +529,8 @@ def user_input(raw_data_input:pd.DataFrame,by:str,inc_amt:float,name:str):
         raw_data_input : raw data in a DataFrame from user input
         by             : columns to resample data by
         inc_amt        : increment amount
+        name           : name of objective to resample by (Year or Depth)
+        base           : name of the input file without extension
 
     Output:
         PDF and CSV files
@@ -344,16 +541,17 @@ def user_input(raw_data_input:pd.DataFrame,by:str,inc_amt:float,name:str):
         print("")
         print('Resample by Year & Depth')
         for n in range(len(name)):
-            set_resample(raw_data_input,by[n],inc_amt,name[n])
+            set_resample(raw_data_input,by[n],inc_amt,name[n],base)
     else:
         print("")
         print('Resample by {}'.format(name))
-        set_resample(raw_data_input,by,inc_amt,name)
+        set_resample(raw_data_input,by,inc_amt,name,base)
 
-file = sys.argv[1]
-base = os.path.basename(file)[:-4]
-raw_data_input = file_to_dataframe(os.path.join('data',file))
-by,name = find_by_columns(raw_data_input,sys.argv[2])
-inc_amt = [float(i) for i in sys.argv[3:]]
+if __name__ == '__main__':
+    file = sys.argv[1]
+    base = os.path.basename(file)[:-4]
+    raw_data_input = file_to_dataframe(os.path.join('data',file))
+    by,name = find_by_columns(raw_data_input,sys.argv[2])
+    inc_amt = [float(i) for i in sys.argv[3:]]
 
-user_input(raw_data_input,by,inc_amt,name)
+    user_input(raw_data_input,by,inc_amt,name,base)
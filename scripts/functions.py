@@ -1,4 +0,0 @@
-def frange(x, y, jump):
-    while x < y:
-        yield x
-        x += jump